@@ -1,30 +1,158 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, make_response
+from flask.json.provider import DefaultJSONProvider
 import os
-import uuid
 import re
+import uuid
+import string
 import subprocess
+import tempfile
 import time
 import threading
 import logging
-from functools import lru_cache
-import hashlib
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
 import requests
+from blake3 import blake3
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import FileWrapper
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, FileTarget, ValueTarget
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Fall back to Flask's stdlib json provider
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson, honouring the json.dumps options orjson supports"""
+    def _encode(self, obj, sort_keys=None, indent=None, default=None, **kwargs):
+        # orjson always emits compact UTF-8, so ensure_ascii, separators and the like don't apply
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2  # The only indent orjson offers
+        return orjson.dumps(obj, default=default or self.default, option=option)
+    
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj, **kwargs).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        """Serialize like jsonify: one argument as is, several as a list, or keyword arguments as an object"""
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        if len(args) == 1:
+            obj = args[0]
+        else:
+            obj = args or kwargs or None
+        
+        # Pretty-print in debug mode unless compact output is forced, as Flask does
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        return self._app.response_class(self._encode(obj, indent=indent) + b"\n", mimetype=self.mimetype)
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # Configuration - Use absolute paths
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_DIR = os.path.join(CURRENT_DIR, "uploads/")
-OUTPUT_DIR = os.path.join(CURRENT_DIR, "converted/")
-TEMP_DIR = os.path.join(CURRENT_DIR, "temp/")  # For temporary compressed videos
+# Uploads and outputs are transient, so in production point this at a tmpfs mount:
+#   mount -t tmpfs -o size=8G tmpfs /mnt/koko-scratch
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", CURRENT_DIR)
+UPLOAD_DIR = os.path.join(SCRATCH_DIR, "uploads/")
+OUTPUT_DIR = os.path.join(SCRATCH_DIR, "converted/")
+TEMP_DIR = os.path.join(SCRATCH_DIR, "temp/")  # FFmpeg stderr logs and spilled /convert-stream output
 MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB max file size
-CACHE_EXPIRY = 3600  # Files expire after 1 hour (in seconds)
+# Files expire after 1 hour by default (in seconds); use a shorter expiry when SCRATCH_DIR is in RAM
+CACHE_EXPIRY = int(os.environ.get("CACHE_EXPIRY", 3600))
+# Scratch files nobody has touched for this long are swept by age alone. Other worker
+# processes keep their own cache index, so this must outlast CACHE_EXPIRY
+STALE_FILE_TTL = 2 * CACHE_EXPIRY
+CLEANUP_INTERVAL = 300  # Longest the cleanup thread sleeps between sweeps (in seconds)
+TOUCH_INTERVAL = 5  # Cache hits within this many seconds of the last one skip the shard lock
+CACHE_SHARDS = 256  # Cache is split by the first byte (two hex digits) of the file hash
+MAX_CACHE_ENTRIES = int(os.environ.get("MAX_CACHE_ENTRIES", 2048))  # Converted files kept on disk at most, across all shards
+# FFmpeg already uses every core (-threads 0), so only run a few conversions at once
+MAX_CONVERSION_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+MAX_PENDING_JOBS = 64  # Queued + running conversions before /convert returns 503
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Read the request body in 1MB chunks
+PIPE_BUFFER_SIZE = 1024 * 1024  # Kernel buffer size for pipes to and from FFmpeg
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Read size when a download has to be copied through Python
+FFMPEG_ERROR_TAIL = 4096  # Bytes of FFmpeg's stderr kept in error messages and logs
+STREAM_SPOOL_SIZE = 32 * 1024 * 1024  # /convert-stream output kept in memory before spilling to TEMP_DIR
+STREAM_SNIFF_SIZE = 1024 * 1024  # /convert-stream bytes held back while checking whether an MP4 can be piped
+PROBE_CACHE_SIZE = 256  # Number of ffprobe results kept in memory
+
+# When running behind nginx, hand downloads off with X-Accel-Redirect to an internal location:
+#   location /_protected_mp3/ { internal; alias /abs/path/to/converted/; }
+# Leave unset to serve files with send_file (e.g. on the dev server)
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "")  # e.g. "/_protected_mp3/"
+
+# Behind Apache/lighttpd with mod_xsendfile, let send_file emit X-Sendfile instead of streaming the body
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE") == "1"
+
+# FFmpeg muxer for each output format; raw AAC is written by the "adts" muxer, there is no "aac" one
+OUTPUT_MUXERS = {
+    'mp3': 'mp3',
+    'aac': 'adts',
+    'wav': 'wav',
+    'ogg': 'ogg'
+}
+# Output formats whose codec can be copied straight from a source stream of the same codec
+STREAM_COPY_CODECS = ('mp3', 'aac')
+ALLOWED_BITRATES = ('128k', '192k', '256k', '320k')
+
+# FFmpeg arguments are assembled once at import; each conversion only adds its input and output
+FFMPEG_BASE_ARGS = ("ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats")  # Keep stderr down to actual errors
+FFMPEG_AUDIO_ONLY_ARGS = ("-map", "0:a:0", "-vn", "-sn", "-dn")  # First audio stream only; skip video, subtitles, data
+FFMPEG_ENCODE_ARGS = {
+    (format_type, bitrate): ("-b:a", bitrate, "-threads", "0", "-f", muxer)
+    for format_type, muxer in OUTPUT_MUXERS.items()
+    for bitrate in ALLOWED_BITRATES
+}
+FFMPEG_COPY_ARGS = {format_type: ("-c:a", "copy", "-f", OUTPUT_MUXERS[format_type]) for format_type in STREAM_COPY_CODECS}
+
+# Content-Type for each output format, so proxied downloads don't rely on nginx guessing
+AUDIO_MIMETYPES = {
+    '.mp3': 'audio/mpeg',
+    '.aac': 'audio/aac',
+    '.wav': 'audio/wav',
+    '.ogg': 'audio/ogg'
+}
+
+# Let Werkzeug reject oversized requests before any of our code runs
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 # Cloudflare Turnstile Configuration
 # Site key from JS: 0x4AAAAAABHoxdccCZ_9Cezk
 # You need to use the secret key paired with this site key
 TURNSTILE_SECRET_KEY = "0x4AAAAAABHoxYr9SKSH_1ZBB4LpXbr_0sQ"  # This is a placeholder - replace with your actual secret key
 TURNSTILE_VERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+TURNSTILE_TIMEOUT = 5  # Seconds to wait on Cloudflare before failing the verification
+TURNSTILE_TOKEN_TTL = 300  # Turnstile tokens are only valid for 5 minutes
+SPENT_TOKEN_CACHE_SIZE = 4096
+
+# One pooled session so verifications reuse a kept-alive TLS connection to Cloudflare
+turnstile_session = requests.Session()
+turnstile_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
+# Tokens Cloudflare has already answered for. Tokens are single-use, so a retry with the same
+# token would be refused anyway; refuse it locally without another round trip
+# Structure: {blake3(token): expiry timestamp}, oldest first
+spent_tokens = OrderedDict()
+spent_tokens_lock = threading.Lock()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -35,13 +163,144 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-# In-memory cache for recent conversions
-# Structure: {file_hash: {"output_path": path, "last_accessed": timestamp}}
-file_cache = {}
-cache_lock = threading.Lock()
+# In-memory cache for recent conversions, sharded so requests for different files don't
+# contend on one lock. Each shard is ordered from least to most recently accessed
+# Structure: file_cache[shard] = {conversion_key: {"output_path": path, "last_accessed": timestamp}}
+file_cache = [OrderedDict() for _ in range(CACHE_SHARDS)]
+cache_locks = [threading.Lock() for _ in range(CACHE_SHARDS)]
+
+# Reverse index from output filename to conversion key, kept in sync with file_cache
+filename_to_key = {}
+index_lock = threading.Lock()
+
+# Conversion jobs, keyed by conversion key
+# Structure: {job_id: {"state": "queued"|"running"|"done"|"failed"|"expired", "updated": timestamp, "upload": filename, ...}}
+jobs = {}
+jobs_lock = threading.Lock()
+conversion_executor = ThreadPoolExecutor(max_workers=MAX_CONVERSION_WORKERS, thread_name_prefix="ffmpeg")
+# /convert-stream runs FFmpeg on the request thread, so it gets its own limit
+stream_slots = threading.BoundedSemaphore(MAX_CONVERSION_WORKERS)
+
+# ffprobe results for recent uploads so retries of the same file skip the probe
+# Structure: {file_hash: {"duration": seconds, "audio": first audio stream info}}
+probe_cache = OrderedDict()
+probe_lock = threading.Lock()
+
+def _shard(key):
+    """Index of the cache shard holding a conversion key (which starts with the file hash)"""
+    return int(key[:2], 16) % CACHE_SHARDS
+
+def add_to_cache(key, output_path):
+    """Record a converted file in the cache as the most recently accessed entry"""
+    s = _shard(key)
+    with cache_locks[s]:
+        previous = file_cache[s].get(key)
+        file_cache[s][key] = {
+            "output_path": output_path,
+            "last_accessed": time.time()
+        }
+        file_cache[s].move_to_end(key)
+    with index_lock:
+        if previous:
+            filename_to_key.pop(os.path.basename(previous["output_path"]), None)
+        filename_to_key[os.path.basename(output_path)] = key
+        over_capacity = len(filename_to_key) - MAX_CACHE_ENTRIES
+    
+    # A file adopted from disk keeps its old mtime; refresh it so the age-based sweep doesn't
+    # remove a file that is still indexed
+    try:
+        os.utime(output_path)
+    except OSError:
+        pass
+    
+    # The index holds one name per cached file, so its size is the global entry count
+    evicted = []
+    for _ in range(over_capacity):
+        entry = pop_oldest_cache_entry()
+        if entry is None:
+            break
+        evicted.append(entry)
+    with index_lock:
+        for _, evicted_path in evicted:
+            filename_to_key.pop(os.path.basename(evicted_path), None)
+    expire_jobs(evicted_key for evicted_key, _ in evicted)
+    
+    # Delete evicted files outside the locks
+    for _, evicted_path in evicted:
+        try:
+            os.remove(evicted_path)
+            logger.info(f"Evicted cached file: {evicted_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error removing file {evicted_path}: {str(e)}")
+
+def pop_oldest_cache_entry():
+    """Remove the least recently accessed entry across all shards and return its (key, output_path)"""
+    # Each shard is in access order, so the global LRU entry is the oldest of the shard heads.
+    # This only runs when a new conversion pushes the cache over capacity
+    while True:
+        oldest = None
+        for s in range(CACHE_SHARDS):
+            with cache_locks[s]:
+                if file_cache[s]:
+                    key, data = next(iter(file_cache[s].items()))
+                    if oldest is None or data["last_accessed"] < oldest[2]:
+                        oldest = (s, key, data["last_accessed"])
+        if oldest is None:
+            return None
+        
+        s, key, _ = oldest
+        with cache_locks[s]:
+            # Retry if the entry was touched or removed since the scan
+            if file_cache[s] and next(iter(file_cache[s])) == key:
+                return key, file_cache[s].popitem(last=False)[1]["output_path"]
+
+def expire_jobs(keys):
+    """Mark finished jobs whose output is being deleted, so /status/<job_id> stops pointing at it"""
+    now = time.time()
+    with jobs_lock:
+        for key in keys:
+            job = jobs.get(key)
+            if job is not None and job["state"] == 'done':
+                job.update(state='expired', updated=now)
+
+def touch_cache_entry(key):
+    """Mark a cache entry as just accessed and return its output path, or None if not cached"""
+    s = _shard(key)
+    now = time.time()
+    
+    # A single dict lookup is atomic, so hot files that were touched moments ago
+    # don't need the lock; a few seconds of staleness doesn't matter against CACHE_EXPIRY
+    data = file_cache[s].get(key)
+    if data is not None and now - data["last_accessed"] < TOUCH_INTERVAL:
+        return data["output_path"]
+    
+    with cache_locks[s]:
+        data = file_cache[s].get(key)
+        if data is None:
+            return None
+        data["last_accessed"] = now
+        file_cache[s].move_to_end(key)
+        output_path = data["output_path"]
+    
+    # Bump the mtime as well, so the disk sweep in other worker processes sees the file is in use
+    try:
+        os.utime(output_path)
+    except OSError:
+        pass
+    return output_path
 
 def verify_turnstile_token(token, remote_ip=None):
     """Verify a Cloudflare Turnstile token with the Cloudflare API"""
+    token_key = blake3(token.encode('utf-8', 'replace')).digest()
+    now = time.time()
+    with spent_tokens_lock:
+        expiry = spent_tokens.get(token_key)
+        if expiry is not None and expiry > now:
+            logger.warning("Turnstile token was already used")
+            return False
+    
     try:
         data = {
             'secret': TURNSTILE_SECRET_KEY,
@@ -54,9 +313,17 @@ def verify_turnstile_token(token, remote_ip=None):
             
         logger.info(f"Verifying Turnstile token for IP: {remote_ip if remote_ip else 'Not provided'}")
         
-        response = requests.post(TURNSTILE_VERIFY_URL, data=data)
+        response = turnstile_session.post(TURNSTILE_VERIFY_URL, data=data, timeout=TURNSTILE_TIMEOUT)
         result = response.json()
         
+        # Whatever the answer, this token can't pass again
+        with spent_tokens_lock:
+            spent_tokens[token_key] = now + TURNSTILE_TOKEN_TTL
+            spent_tokens.move_to_end(token_key)
+            while spent_tokens and (len(spent_tokens) > SPENT_TOKEN_CACHE_SIZE
+                                    or next(iter(spent_tokens.values())) <= now):
+                spent_tokens.popitem(last=False)
+        
         # Log verification attempt
         if result.get('success'):
             logger.info("Turnstile verification successful")
@@ -69,51 +336,198 @@ def verify_turnstile_token(token, remote_ip=None):
         logger.error(f"Error verifying Turnstile token: {str(e)}")
         return False
 
+HEX_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+
+_SAFE_FILENAME_CHARS = frozenset(string.ascii_letters + string.digits + '_-.')
+
+class _FilenameTable(dict):
+    """str.translate table: spaces become underscores, any other unsafe code point is dropped"""
+    def __missing__(self, codepoint):
+        # Only ASCII is precomputed; anything else is unsafe and isn't stored, since
+        # filenames come from clients and could otherwise grow the table without bound
+        return None
+
+_FILENAME_TABLE = _FilenameTable(
+    (codepoint, codepoint if chr(codepoint) in _SAFE_FILENAME_CHARS else None) for codepoint in range(128)
+)
+_FILENAME_TABLE[ord(' ')] = '_'
+
 def sanitize_filename(name):
     """Remove any path info and sanitize the file name"""
-    name = os.path.basename(name)
-    name = name.replace(' ', '_')
-    name = re.sub(r'[^A-Za-z0-9_\-\.]', '', name)
-    return name
-
-def generate_unique_filename(original_name):
-    """Generate a unique filename based on the original name"""
-    filename, extension = os.path.splitext(original_name)
-    unique_id = uuid.uuid4().hex[:10]
-    return f"{sanitize_filename(filename)}_{unique_id}{extension}"
-
-def generate_file_hash(file_obj):
-    """Generate SHA-256 hash of file contents for caching"""
-    file_hash = hashlib.sha256()
-    chunk_size = 8192  # Read in 8kb chunks
-    file_obj.seek(0)
-    
-    for chunk in iter(lambda: file_obj.read(chunk_size), b''):
-        file_hash.update(chunk)
-    
-    file_obj.seek(0)  # Reset file pointer
-    return file_hash.hexdigest()
-
-def get_video_duration(video_path):
-    """Get the duration of a video file in seconds using FFprobe"""
+    return os.path.basename(name).translate(_FILENAME_TABLE)
+
+def conversion_key(file_hash, format_type, bitrate):
+    """Key for one conversion of an upload: the same bytes and settings always give the same key"""
+    return f"{file_hash[:32]}_{bitrate}_{format_type}"
+
+def parse_conversion_options(format_type, bitrate):
+    """Validate the requested format and bitrate, falling back to mp3 at 192k"""
+    if format_type not in OUTPUT_MUXERS:
+        format_type = 'mp3'  # Default to mp3 if invalid
+    if bitrate not in ALLOWED_BITRATES:
+        bitrate = '192k'  # Default to 192k if invalid
+    return format_type, bitrate
+
+def output_filename_for(key, format_type):
+    """Content-addressed output file name, independent of what the upload was called"""
+    return f"{key}.{format_type}"
+
+class HashingFileTarget(FileTarget):
+    """FileTarget that hashes the uploaded part while writing it to disk"""
+    def __init__(self, filename):
+        super().__init__(filename)
+        # Only a cache key, so use BLAKE3 which hashes several times faster than SHA-256
+        self.file_hash = blake3()
+        # Set once the parser reaches the end of the part, so truncated bodies can be told apart
+        self.complete = False
+    
+    def on_data_received(self, chunk):
+        self.file_hash.update(chunk)
+        super().on_data_received(chunk)
+    
+    def on_finish(self):
+        super().on_finish()
+        self.complete = True
+    
+    def close(self):
+        """Close the file if the parser never finished the part, e.g. after an aborted upload"""
+        if self._fd is not None and not self._fd.closed:
+            self._fd.close()
+
+def mp4_index_first(head):
+    """Whether an ISO-BMFF (MP4/MOV) upload has its moov index before the media data.
+
+    FFmpeg can only demux these from a pipe when moov comes first. Returns True for
+    anything else, False when mdat comes first, and None if head is too short to tell
+    """
+    if len(head) < 8:
+        return None
+    if head[4:8] != b'ftyp':
+        return True  # Not an MP4 family file; other containers demux fine from a pipe
+    pos = 0
+    while pos + 8 <= len(head):
+        size = int.from_bytes(head[pos:pos + 4], 'big')
+        box_type = head[pos + 4:pos + 8]
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1:
+            # 64-bit box size follows the type
+            if pos + 16 > len(head):
+                return None
+            size = int.from_bytes(head[pos + 8:pos + 16], 'big')
+        if size < 8:
+            return True  # Box runs to the end of the file or is malformed; let FFmpeg decide
+        pos += size
+    return None
+
+class FFmpegStartError(Exception):
+    """FFmpeg could not be spawned (missing binary, or out of processes or file descriptors)"""
+
+class StreamingVideoTarget(BaseTarget):
+    """Target that feeds the uploaded part to FFmpeg's stdin once it knows FFmpeg can demux it from a pipe.
+
+    MP4/MOV files with the moov index at the end (most phone recordings) are written to
+    fallback_path instead, so FFmpeg can seek in them after the upload completes
+    """
+    def __init__(self, open_pipe, fallback_path):
+        super().__init__()
+        self.open_pipe = open_pipe
+        self.fallback_path = fallback_path
+        self.use_fallback = False
+        self.complete = False
+        self._head = bytearray()
+        self._sink = None
+    
+    def _choose_sink(self, streamable):
+        if streamable is False:
+            self.use_fallback = True
+            self._sink = open(self.fallback_path, 'wb')
+        else:
+            self._sink = self.open_pipe()
+        self._sink.write(self._head)
+        self._head = None
+    
+    def on_data_received(self, chunk):
+        if self._sink is not None:
+            self._sink.write(chunk)
+            return
+        self._head += chunk
+        streamable = mp4_index_first(self._head)
+        if streamable is not None or len(self._head) >= STREAM_SNIFF_SIZE:
+            self._choose_sink(streamable)
+    
+    def on_finish(self):
+        if self._sink is None:
+            self._choose_sink(mp4_index_first(self._head))
+        if self.use_fallback:
+            self._sink.close()
+        self.complete = True
+    
+    def close(self):
+        """Close the fallback file if the upload was aborted before the part finished"""
+        if self.use_fallback and self._sink is not None and not self._sink.closed:
+            self._sink.close()
+
+def enlarge_pipe(pipe):
+    """Grow a pipe's kernel buffer so FFmpeg isn't fed through the default 64KB"""
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+    except OSError as e:
+        logger.warning(f"Could not enlarge pipe buffer: {str(e)}")
+
+def large_buffer_file_wrapper(file_obj, buffer_size=DOWNLOAD_CHUNK_SIZE):
+    """wsgi.file_wrapper for servers without one, reading in DOWNLOAD_CHUNK_SIZE blocks instead of 8KB"""
+    return FileWrapper(file_obj, max(buffer_size, DOWNLOAD_CHUNK_SIZE))
+
+def generate_chunks(file_obj, chunk_size=PIPE_BUFFER_SIZE):
+    """Yield a file's contents in chunks, closing it when done"""
+    try:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+            yield chunk
+    finally:
+        file_obj.close()
+
+def probe_media(video_path, file_hash):
+    """Get the duration and first audio stream of a video file with one FFprobe call, cached by file hash"""
+    with probe_lock:
+        if file_hash in probe_cache:
+            probe_cache.move_to_end(file_hash)
+            return probe_cache[file_hash]
+    
     try:
         cmd = [
-            "ffprobe", 
-            "-v", "error", 
-            "-show_entries", "format=duration", 
-            "-of", "default=noprint_wrappers=1:nokey=1", 
+            "ffprobe",
+            "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "format=duration:stream=codec_name,bit_rate,sample_rate,channels",
+            "-of", "json",
             video_path
         ]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        duration = float(result.stdout.strip())
-        return duration
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        probe = json.loads(result.stdout)
     except Exception as e:
-        logger.error(f"Error getting video duration: {str(e)}")
-        return 0  # Return 0 if duration cannot be determined
+        logger.error(f"Error probing video: {str(e)}")
+        return {"duration": 0, "audio": {}}  # Don't cache failures
+    
+    streams = probe.get("streams", [])
+    try:
+        duration = float(probe.get("format", {}).get("duration", 0))
+    except ValueError:
+        duration = 0  # Return 0 if duration cannot be determined
+    info = {"duration": duration, "audio": streams[0] if streams else {}}
+    
+    with probe_lock:
+        probe_cache[file_hash] = info
+        if len(probe_cache) > PROBE_CACHE_SIZE:
+            probe_cache.popitem(last=False)
+    return info
 
-@lru_cache(maxsize=10)
-def get_ffmpeg_version():
-    """Cache the FFmpeg version to avoid repeated subprocess calls"""
+def _probe_ffmpeg_version():
+    """Ask the FFmpeg binary for its version string"""
     try:
         process = subprocess.run(
             ["ffmpeg", "-version"],
@@ -124,54 +538,237 @@ def get_ffmpeg_version():
         )
         return process.stdout.split('\n')[0]
     except Exception as e:
+        logger.warning(f"FFmpeg version check failed: {str(e)}")
         return f"FFmpeg version check failed: {str(e)}"
 
+# Probed once at import so /status never has to spawn a process
+FFMPEG_VERSION = _probe_ffmpeg_version()
+
+def get_ffmpeg_version():
+    """Return the FFmpeg version detected at startup"""
+    return FFMPEG_VERSION
+
 def cleanup_expired_files():
     """Remove files that haven't been accessed for CACHE_EXPIRY seconds"""
     current_time = time.time()
-    with cache_lock:
-        expired_keys = []
-        for key, data in file_cache.items():
-            if current_time - data["last_accessed"] > CACHE_EXPIRY:
-                try:
-                    if os.path.exists(data["output_path"]):
-                        os.remove(data["output_path"])
-                        logger.info(f"Removed expired file: {data['output_path']}")
-                    expired_keys.append(key)
-                except Exception as e:
-                    logger.error(f"Error removing file {data['output_path']}: {str(e)}")
-        
-        # Remove expired entries from cache
-        for key in expired_keys:
-            del file_cache[key]
-            
-    # Also clean up any leftover files in the temp directory
-    for filename in os.listdir(TEMP_DIR):
-        file_path = os.path.join(TEMP_DIR, filename)
+    cutoff = current_time - CACHE_EXPIRY
+    
+    # Entries are kept in access order, so only the expired head of each shard is popped.
+    # Shards are locked one at a time so the rest of the cache stays available
+    expired_keys = []
+    expired_paths = []
+    for s in range(CACHE_SHARDS):
+        with cache_locks[s]:
+            while file_cache[s]:
+                data = next(iter(file_cache[s].values()))
+                if data["last_accessed"] >= cutoff:
+                    break
+                expired_keys.append(file_cache[s].popitem(last=False)[0])
+                expired_paths.append(data["output_path"])
+    
+    with index_lock:
+        for output_path in expired_paths:
+            filename_to_key.pop(os.path.basename(output_path), None)
+    expire_jobs(expired_keys)
+    
+    # Forget finished jobs once their output would have expired
+    with jobs_lock:
+        finished = [job_id for job_id, job in jobs.items()
+                    if job["state"] in ('done', 'failed', 'expired') and job["updated"] < cutoff]
+        for job_id in finished:
+            del jobs[job_id]
+    
+    # Delete the files outside the lock so requests aren't blocked on disk I/O
+    for output_path in expired_paths:
         try:
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getmtime(file_path)
-                if file_age > CACHE_EXPIRY:
-                    os.remove(file_path)
-                    logger.info(f"Removed expired temp file: {file_path}")
+            os.remove(output_path)
+            logger.info(f"Removed expired file: {output_path}")
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f"Error cleaning temp file {file_path}: {str(e)}")
+            logger.error(f"Error removing file {output_path}: {str(e)}")
+            
+    # Also clean up leftover scratch files: converted files no worker's cache still uses (or
+    # left over from before a restart), and uploads whose request or job died. The cache
+    # index is per process, so age is the only signal that's safe across workers
+    stale_cutoff = current_time - STALE_FILE_TTL
+    with jobs_lock:
+        active_uploads = {job["upload"] for job in jobs.values() if job["state"] in ('queued', 'running')}
+    sweep_stale_files(TEMP_DIR, cutoff)
+    sweep_stale_files(OUTPUT_DIR, stale_cutoff)
+    sweep_stale_files(UPLOAD_DIR, stale_cutoff, keep=active_uploads)
+
+def sweep_stale_files(directory, cutoff, keep=()):
+    """Delete files in a directory last modified or accessed before cutoff, except the names in keep"""
+    # scandir hands back the file type with each entry, so only one stat per file is needed
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in keep:
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat()
+                if max(stat.st_mtime, stat.st_atime) < cutoff:
+                    os.remove(entry.path)
+                    logger.info(f"Removed stale file: {entry.path}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error cleaning file {entry.path}: {str(e)}")
+
+def get_next_cleanup_delay():
+    """Seconds until the least recently accessed cache entry expires"""
+    oldest_access = None
+    for s in range(CACHE_SHARDS):
+        with cache_locks[s]:
+            if file_cache[s]:
+                last_accessed = next(iter(file_cache[s].values()))["last_accessed"]
+                if oldest_access is None or last_accessed < oldest_access:
+                    oldest_access = last_accessed
+    if oldest_access is None:
+        return CLEANUP_INTERVAL
+    delay = oldest_access + CACHE_EXPIRY - time.time()
+    return min(max(delay, 0), CLEANUP_INTERVAL)
 
 def start_cleanup_thread():
-    """Start a background thread to periodically clean up expired files"""
+    """Start a background thread that cleans up files as they expire"""
+    stop_event = threading.Event()
+    
     def cleanup_task():
         while True:
             cleanup_expired_files()
-            time.sleep(300)  # Run every 5 minutes
+            # Wake up when the oldest entry is due instead of polling on a fixed period
+            if stop_event.wait(timeout=get_next_cleanup_delay()):
+                break
 
     cleanup_thread = threading.Thread(target=cleanup_task, daemon=True)
     cleanup_thread.start()
+    return stop_event
+
+def run_ffmpeg(ffmpeg_command, err_file):
+    """Run FFmpeg with stdout discarded and stderr written to err_file, returning its exit code"""
+    if hasattr(os, 'posix_spawnp'):
+        # posix_spawn skips fork(), which would copy the page tables of this whole process
+        pid = os.posix_spawnp(ffmpeg_command[0], ffmpeg_command, os.environ, file_actions=[
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+            (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+            (os.POSIX_SPAWN_DUP2, err_file.fileno(), 2)
+        ])
+        _, wait_status = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(wait_status)
+    
+    process = subprocess.run(
+        ffmpeg_command, 
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, 
+        stderr=err_file,
+        check=False
+    )
+    return process.returncode
+
+def read_ffmpeg_error(err_file):
+    """Decode the tail of FFmpeg's stderr, which is only read once a run has failed"""
+    size = err_file.seek(0, os.SEEK_END)
+    err_file.seek(max(0, size - FFMPEG_ERROR_TAIL))
+    return err_file.read().decode('utf-8', 'replace')
+
+def can_stream_copy(audio_info, format_type, bitrate):
+    """Whether the probed source audio can be copied unchanged for this format and bitrate"""
+    if format_type not in STREAM_COPY_CODECS or audio_info.get("codec_name") != format_type:
+        return False
+    # A copy keeps the source's sample rate and channels, which must match what encoding produces
+    if audio_info.get("sample_rate") != "44100" or audio_info.get("channels") != 2:
+        return False
+    # Never hand back a larger file than the requested bitrate; unknown bitrates get re-encoded
+    try:
+        source_bitrate = int(audio_info.get("bit_rate"))
+    except (TypeError, ValueError):
+        return False
+    return source_bitrate <= int(bitrate.rstrip('k')) * 1000
+
+def update_job(job_id, **fields):
+    """Update the state of a conversion job"""
+    with jobs_lock:
+        jobs[job_id].update(fields, updated=time.time())
+
+def convert_video_file(job_id, file_hash, video_path, output_path, format_type, bitrate):
+    """Worker that extracts the audio from an uploaded video (job_id is its conversion key)"""
+    update_job(job_id, state='running')
+    # FFmpeg writes to a private temp name that is only renamed into place once it succeeds, so
+    # a failed or interrupted run never leaves a partial file under the content-addressed name
+    partial_path = f"{output_path}.{uuid.uuid4().hex}.part"
+    try:
+        # A single probe gives the duration (for informational purposes) and the audio codec
+        media_info = probe_media(video_path, file_hash)
+        duration = media_info["duration"]
+        audio_info = media_info["audio"]
+        logger.info(f"Video duration: {duration} seconds")
+        
+        # Copy the audio stream as-is when it already matches what was asked for instead of re-encoding it
+        stream_copy = can_stream_copy(audio_info, format_type, bitrate)
+        
+        # FFmpeg command to extract audio (the muxer is always given, so the .part suffix is fine)
+        ffmpeg_command = [*FFMPEG_BASE_ARGS, "-y", "-i", video_path, *FFMPEG_AUDIO_ONLY_ARGS]
+        if stream_copy:
+            logger.info(f"Source audio is already {format_type.upper()}, copying stream")
+            ffmpeg_command += FFMPEG_COPY_ARGS[format_type]  # Remux without decoding
+        else:
+            # Only resample / remix when the source isn't already 44.1kHz stereo
+            if audio_info.get("sample_rate") != "44100":
+                ffmpeg_command += ["-ar", "44100"]
+            if audio_info.get("channels") != 2:
+                ffmpeg_command += ["-ac", "2"]
+            ffmpeg_command += FFMPEG_ENCODE_ARGS[(format_type, bitrate)]  # Bitrate, all threads, muxer
+        ffmpeg_command.append(partial_path)
+        
+        # Send stderr to a temp file rather than a pipe; it's only read on failure
+        with tempfile.TemporaryFile(dir=TEMP_DIR) as err_tmp:
+            returncode = run_ffmpeg(ffmpeg_command, err_tmp)
+            
+            # Check if conversion was successful
+            if returncode != 0:
+                err_text = read_ffmpeg_error(err_tmp)
+                raise Exception(f"FFmpeg conversion failed: {err_text}")
+        
+        # Check if output file exists
+        if not os.path.exists(partial_path):
+            raise Exception("Output file was not created")
+        os.replace(partial_path, output_path)
+        
+        # Add to cache under the conversion key
+        add_to_cache(job_id, output_path)
+        
+        logger.info(f"File converted and cached: {output_path}")
+        
+        # Clean up temporary files
+        os.remove(video_path)
+        
+        update_job(
+            job_id,
+            state='done',
+            filename=os.path.basename(output_path),
+            duration=duration,
+            format=format_type,
+            bitrate=bitrate
+        )
+        
+    except Exception as e:
+        # Log the full error for debugging
+        logger.error(f"Conversion error: {str(e)}")
+        
+        # Delete the uploaded file and any partial output if there was an error
+        for leftover in (video_path, partial_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        
+        update_job(job_id, state='failed', error=str(e))
 
 # Global CORS headers
 CORS_HEADERS = {
     'Access-Control-Allow-Origin': 'https://tokhaste.com',  # Change to specific domain in production
     'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
-    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, CF-Turnstile-Response, X-Content-BLAKE3',
     'Access-Control-Max-Age': '3600'  # Cache preflight response for 1 hour
 }
 
@@ -181,213 +778,444 @@ def convert_video():
     if request.method == 'OPTIONS':
         return '', 204, CORS_HEADERS  # Return 204 No Content for OPTIONS
     
-    # Verify Cloudflare Turnstile token
-    token = request.form.get('cf-turnstile-response')
-    remote_ip = request.remote_addr
+    # Reject oversized uploads from the Content-Length header before reading the body
+    too_large = {'success': False, 'error': f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"}
+    if request.content_length and request.content_length > MAX_FILE_SIZE:
+        return jsonify(too_large), 413
     
-    if not token:
-        logger.warning("Turnstile token missing in request")
-        response = {'success': False, 'error': "Security verification required"}
-        return jsonify(response), 400
+    # A client that already knows the file's BLAKE3 digest can ask for a cached conversion
+    # without uploading; format and bitrate then come from the query string
+    claimed_hash = request.headers.get('X-Content-BLAKE3', '').lower()
+    token_verified = False
+    if claimed_hash:
+        if not HEX_DIGEST_RE.fullmatch(claimed_hash):
+            response = {'success': False, 'error': "Invalid X-Content-BLAKE3 header"}
+            return jsonify(response), 400
+        
+        # The lookup reveals which files have been converted, so it needs the same
+        # verification as an upload. The token comes in a header since there may be no body
+        token = request.headers.get('CF-Turnstile-Response')
+        remote_ip = request.remote_addr
+        if not token:
+            logger.warning("Turnstile token missing in request")
+            response = {'success': False, 'error': "Security verification required"}
+            return jsonify(response), 400
+        if not verify_turnstile_token(token, remote_ip):
+            logger.warning(f"Invalid Turnstile token from IP: {remote_ip}")
+            response = {'success': False, 'error': "Security verification failed"}
+            return jsonify(response), 403
+        # Tokens are single-use, so an upload that follows a miss is already verified
+        token_verified = True
+        
+        format_type, bitrate = parse_conversion_options(request.args.get('format', ''), request.args.get('bitrate', ''))
+        key = conversion_key(claimed_hash, format_type, bitrate)
+        output_path = touch_cache_entry(key)
+        if output_path and os.path.exists(output_path):
+            logger.info(f"Using cached file without upload: {output_path}")
+            return jsonify({
+                'success': True,
+                'filename': os.path.basename(output_path),
+                'cached': True
+            })
+        # A chunked body has no Content-Length but is still an upload
+        has_body = request.content_length or 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+        if not has_body:
+            response = {'success': False, 'error': "File not cached, upload it to convert"}
+            return jsonify(response), 404
     
-    # Verify the token with Cloudflare
-    if not verify_turnstile_token(token, remote_ip):
-        logger.warning(f"Invalid Turnstile token from IP: {remote_ip}")
-        response = {'success': False, 'error': "Security verification failed"}
-        return jsonify(response), 403
+    # Stream the multipart body straight to disk instead of letting Werkzeug's
+    # form parser buffer the whole upload first
+    video_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.upload")
+    video_target = HashingFileTarget(video_path)
+    token_target = ValueTarget()
+    format_target = ValueTarget()
+    bitrate_target = ValueTarget()
     
-    # Check if file is uploaded
-    if 'video' not in request.files:
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except ParseFailedException:
         response = {'success': False, 'error': "No file uploaded"}
         return jsonify(response), 400
     
-    video_file = request.files['video']
-    
-    # Check if filename is empty
-    if video_file.filename == '':
-        response = {'success': False, 'error': "No file selected"}
-        return jsonify(response), 400
-    
-    # Validate file size (Flask doesn't have built-in size checking before reading)
-    video_file.seek(0, os.SEEK_END)
-    file_size = video_file.tell()
-    video_file.seek(0)  # Reset file pointer
-    
-    if file_size > MAX_FILE_SIZE:
-        response = {'success': False, 'error': f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"}
-        return jsonify(response), 400
+    parser.register('video', video_target)
+    parser.register('cf-turnstile-response', token_target)
+    parser.register('format', format_target)
+    parser.register('bitrate', bitrate_target)
     
+    # The upload is removed on every path except a queued job, which takes it over.
+    # This also covers client disconnects and any other exception while reading the body
+    keep_upload = False
     try:
-        # Generate file hash for caching
-        file_hash = generate_file_hash(video_file)
-        
-        # Check if we already have this file converted
-        with cache_lock:
-            if file_hash in file_cache and os.path.exists(file_cache[file_hash]["output_path"]):
-                output_path = file_cache[file_hash]["output_path"]
-                file_cache[file_hash]["last_accessed"] = time.time()
-                output_filename = os.path.basename(output_path)
-                
-                logger.info(f"Using cached file: {output_path}")
-                
-                return jsonify({
-                    'success': True,
-                    'filename': output_filename,
-                    'cached': True
-                })
-        
-        # Generate unique filenames
-        unique_video_name = generate_unique_filename(video_file.filename)
-        video_path = os.path.join(UPLOAD_DIR, unique_video_name)
-        
-        # Generate output filename (replace extension with mp3)
-        output_filename = os.path.splitext(unique_video_name)[0] + '.mp3'
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-        
-        # Save the uploaded file
-        video_file.save(video_path)
+        received = 0
+        try:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # Count bytes as they arrive in case Content-Length was missing
+                received += len(chunk)
+                if received > MAX_FILE_SIZE:
+                    raise RequestEntityTooLarge()
+                parser.data_received(chunk)
+        except RequestEntityTooLarge:
+            # Abort early rather than writing the rest of an oversized upload
+            return jsonify(too_large), 413
+        except ParseFailedException as e:
+            logger.warning(f"Malformed upload: {str(e)}")
+            response = {'success': False, 'error': "Malformed upload"}
+            return jsonify(response), 400
         
-        # Check video duration (keeping for informational purposes)
-        duration = get_video_duration(video_path)
-        logger.info(f"Video duration: {duration} seconds")
+        # Check if file is uploaded
+        if video_target.multipart_filename is None:
+            response = {'success': False, 'error': "No file uploaded"}
+            return jsonify(response), 400
         
-        # Source video to use for conversion - always use the original video
-        source_video_path = video_path
+        # The parser only finishes a part when it sees the next boundary, so a body that was
+        # cut short leaves a partial file that must not be hashed or converted
+        if not video_target.complete:
+            logger.warning("Upload ended before the video part was complete")
+            response = {'success': False, 'error': "Incomplete upload"}
+            return jsonify(response), 400
         
-        # Get format and bitrate (if provided)
-        format_type = request.form.get('format', 'mp3')
-        bitrate = request.form.get('bitrate', '192k')
+        # Verify Cloudflare Turnstile token, unless the X-Content-BLAKE3 lookup already did
+        if not token_verified:
+            token = token_target.value.decode('utf-8', 'replace')
+            remote_ip = request.remote_addr
+            
+            if not token:
+                logger.warning("Turnstile token missing in request")
+                response = {'success': False, 'error': "Security verification required"}
+                return jsonify(response), 400
+            
+            # Verify the token with Cloudflare
+            if not verify_turnstile_token(token, remote_ip):
+                logger.warning(f"Invalid Turnstile token from IP: {remote_ip}")
+                response = {'success': False, 'error': "Security verification failed"}
+                return jsonify(response), 403
         
-        # Validate format and bitrate
-        if format_type not in ['mp3', 'aac', 'wav', 'ogg']:
-            format_type = 'mp3'  # Default to mp3 if invalid
+        # Check if filename is empty
+        if video_target.multipart_filename == '':
+            response = {'success': False, 'error': "No file selected"}
+            return jsonify(response), 400
         
-        if bitrate not in ['128k', '192k', '256k', '320k']:
-            bitrate = '192k'  # Default to 192k if invalid
+        file_size = os.path.getsize(video_path)
+        logger.info(f"Received upload of {file_size} bytes")
         
-        # Adjust output filename based on format
-        if format_type != 'mp3':
-            output_filename = os.path.splitext(unique_video_name)[0] + f'.{format_type}'
-            output_path = os.path.join(OUTPUT_DIR, output_filename)
+        # The hash was computed while the upload was being written
+        file_hash = video_target.file_hash.hexdigest()
         
-        # FFmpeg command to extract audio
-        ffmpeg_command = [
-            "ffmpeg", 
-            "-i", source_video_path, 
-            "-vn",  # No video
-            "-ar", "44100",  # Audio sample rate
-            "-ac", "2",  # Stereo
-            "-b:a", bitrate,  # Use selected bitrate
-            "-threads", "0",  # Use all available threads
-            "-bufsize", "3M",  # Smaller buffer size
-            "-maxrate", "384k",  # Maximum bitrate
-            "-preset", "ultrafast",  # Use fastest preset
-            "-f", format_type,  # Use selected format
-            output_path
-        ]
+        # Get format and bitrate (if provided). After a digest lookup they already came from
+        # the query string, and the upload must produce what the lookup missed
+        if not claimed_hash:
+            format_type, bitrate = parse_conversion_options(
+                format_target.value.decode('utf-8', 'replace'),
+                bitrate_target.value.decode('utf-8', 'replace')
+            )
         
-        process = subprocess.run(
-            ffmpeg_command, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            text=True
-        )
+        # Outputs are keyed by content and settings, so anyone uploading the same bytes
+        # under any name reuses the same file, and a different format never hits a stale one
+        key = conversion_key(file_hash, format_type, bitrate)
+        output_filename = output_filename_for(key, format_type)
+        output_path = os.path.join(OUTPUT_DIR, output_filename)
         
-        # Check if conversion was successful
-        if process.returncode != 0:
-            raise Exception(f"FFmpeg conversion failed: {process.stderr}")
+        # Check if we already have this file converted
+        if touch_cache_entry(key) and os.path.exists(output_path):
+            logger.info(f"Using cached file: {output_path}")
+            return jsonify({
+                'success': True,
+                'filename': output_filename,
+                'cached': True
+            })
         
-        # Check if output file exists
-        if not os.path.exists(output_path):
-            raise Exception("Output file was not created")
+        # Hand the conversion to the worker pool so this request thread is freed right away
+        with jobs_lock:
+            job = jobs.get(key)
+            in_flight = job is not None and job["state"] in ('queued', 'running')
+            # The output may still be on disk from before a restart
+            on_disk = not in_flight and os.path.exists(output_path)
+            busy = False
+            if not in_flight and not on_disk:
+                pending = sum(1 for j in jobs.values() if j["state"] in ('queued', 'running'))
+                busy = pending >= MAX_PENDING_JOBS
+                if not busy:
+                    jobs[key] = {"state": 'queued', "updated": time.time(), "upload": os.path.basename(video_path)}
         
-        # Add to cache using file hash
-        with cache_lock:
-            file_cache[file_hash] = {
-                "output_path": output_path,
-                "last_accessed": time.time()
-            }
+        if in_flight:
+            # The same file is already being converted
+            return jsonify({'success': True, 'job_id': key, 'state': job["state"]}), 202
         
-        logger.info(f"File converted and cached: {output_path}")
+        if on_disk:
+            add_to_cache(key, output_path)
+            logger.info(f"Using existing file: {output_path}")
+            return jsonify({
+                'success': True,
+                'filename': output_filename,
+                'cached': True
+            })
         
-        # Clean up temporary files
-        os.remove(video_path)
+        if busy:
+            response = {'success': False, 'error': "Server is busy, please try again later"}
+            return jsonify(response), 503
         
-        # Return success response
-        response = {
-            'success': True,
-            'filename': output_filename,
-            'duration': duration,
-            'format': format_type,
-            'bitrate': bitrate,
-            'cached': False
-        }
+        conversion_executor.submit(convert_video_file, key, file_hash, video_path, output_path, format_type, bitrate)
+        keep_upload = True
+        logger.info(f"Queued conversion job {key}")
         
-        return jsonify(response)
+        return jsonify({'success': True, 'job_id': key, 'state': 'queued'}), 202
         
     except Exception as e:
         # Log the full error for debugging
         logger.error(f"Conversion error: {str(e)}")
         
-        # Delete the uploaded file if there was an error
-        if 'video_path' in locals() and os.path.exists(video_path):
+        response = {'success': False, 'error': str(e)}
+        return jsonify(response), 500
+    finally:
+        video_target.close()
+        if not keep_upload and os.path.exists(video_path):
             os.remove(video_path)
+
+@app.route('/convert-stream', methods=['POST', 'OPTIONS'])
+def convert_video_stream():
+    """Convert an upload to MP3 without caching, piping it through FFmpeg instead of via disk"""
+    # Handle preflight OPTIONS request
+    if request.method == 'OPTIONS':
+        return '', 204, CORS_HEADERS
+    
+    too_large = {'success': False, 'error': f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"}
+    if request.content_length and request.content_length > MAX_FILE_SIZE:
+        return jsonify(too_large), 413
+    
+    # The token comes in a header so it can be checked before FFmpeg sees any bytes
+    token = request.headers.get('CF-Turnstile-Response')
+    remote_ip = request.remote_addr
+    
+    if not token:
+        logger.warning("Turnstile token missing in request")
+        response = {'success': False, 'error': "Security verification required"}
+        return jsonify(response), 400
+    
+    if not verify_turnstile_token(token, remote_ip):
+        logger.warning(f"Invalid Turnstile token from IP: {remote_ip}")
+        response = {'success': False, 'error': "Security verification failed"}
+        return jsonify(response), 403
+    
+    _, bitrate = parse_conversion_options('mp3', request.args.get('bitrate', ''))
+    
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except ParseFailedException:
+        response = {'success': False, 'error': "No file uploaded"}
+        return jsonify(response), 400
+    
+    if not stream_slots.acquire(blocking=False):
+        response = {'success': False, 'error': "Server is busy, please try again later"}
+        return jsonify(response), 503
+    
+    ffmpeg = {}
+    output = None
+    
+    def start_ffmpeg(source, stdin):
+        """Start FFmpeg on source and drain its output into a spool on a reader thread"""
+        nonlocal output
+        # The source can't be probed before it arrives, so always resample to 44.1kHz stereo
+        ffmpeg_command = [
+            *FFMPEG_BASE_ARGS,
+            "-i", source,
+            *FFMPEG_AUDIO_ONLY_ARGS,
+            "-ar", "44100",
+            "-ac", "2",
+            *FFMPEG_ENCODE_ARGS[('mp3', bitrate)],
+            "pipe:1"
+        ]
+        try:
+            process = subprocess.Popen(
+                ffmpeg_command,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=err_tmp,
+                bufsize=PIPE_BUFFER_SIZE
+            )
+        except OSError as e:
+            # Raised from inside the parser, so it needs its own type to be told apart from upload errors
+            raise FFmpegStartError(str(e)) from e
+        ffmpeg['process'] = process
+        if process.stdin:
+            enlarge_pipe(process.stdin)
+        enlarge_pipe(process.stdout)
         
-        response = {'success': False, 'error': str(e)}
+        # WSGI can't send the response while the request body is still being read, so
+        # the output is drained into a spool while FFmpeg encodes alongside the upload
+        output = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE, dir=TEMP_DIR)
+        reader = threading.Thread(
+            target=shutil.copyfileobj,
+            args=(process.stdout, output, PIPE_BUFFER_SIZE),
+            daemon=True
+        )
+        reader.start()
+        ffmpeg['reader'] = reader
+        return process.stdin
+    
+    fallback_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.upload")
+    video_target = StreamingVideoTarget(lambda: start_ffmpeg("pipe:0", subprocess.PIPE), fallback_path)
+    parser.register('video', video_target)
+    
+    err_tmp = None
+    converted = False
+    try:
+        # Opened inside the try so the slot is still released if TEMP_DIR is full
+        err_tmp = tempfile.TemporaryFile(dir=TEMP_DIR)
+        pipe_closed = False
+        received = 0
+        try:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if received > MAX_FILE_SIZE:
+                    raise RequestEntityTooLarge()
+                parser.data_received(chunk)
+        except RequestEntityTooLarge:
+            return jsonify(too_large), 413
+        except ParseFailedException as e:
+            logger.warning(f"Malformed upload: {str(e)}")
+            response = {'success': False, 'error': "Malformed upload"}
+            return jsonify(response), 400
+        except BrokenPipeError:
+            # FFmpeg gave up on the input; its stderr explains why
+            pipe_closed = True
+        
+        if video_target.multipart_filename is None:
+            response = {'success': False, 'error': "No file uploaded"}
+            return jsonify(response), 400
+        
+        if not video_target.complete and not pipe_closed:
+            response = {'success': False, 'error': "Incomplete upload"}
+            return jsonify(response), 400
+        
+        if video_target.use_fallback:
+            # The moov index is at the end, so FFmpeg needs the whole file to seek in
+            start_ffmpeg(fallback_path, subprocess.DEVNULL)
+        else:
+            try:
+                ffmpeg['process'].stdin.close()
+            except BrokenPipeError:
+                pass
+        
+        returncode = ffmpeg['process'].wait()
+        ffmpeg['reader'].join()
+        
+        if returncode != 0:
+            err_text = read_ffmpeg_error(err_tmp)
+            logger.error(f"Stream conversion failed: {err_text}")
+            response = {'success': False, 'error': f"FFmpeg conversion failed: {err_text}"}
+            return jsonify(response), 500
+        
+        converted = True
+    except FFmpegStartError as e:
+        logger.error(f"Could not start FFmpeg: {str(e)}")
+        response = {'success': False, 'error': "Could not start FFmpeg"}
         return jsonify(response), 500
+    finally:
+        # Runs on every exit, including client disconnects, so FFmpeg and the reader never outlive the request
+        process = ffmpeg.get('process')
+        if process:
+            if process.poll() is None:
+                process.kill()
+            if process.stdin:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            process.wait()
+            ffmpeg['reader'].join()
+        if output and not converted:
+            output.close()
+        video_target.close()
+        if os.path.exists(fallback_path):
+            os.remove(fallback_path)
+        if err_tmp:
+            err_tmp.close()
+        stream_slots.release()
+    
+    output.seek(0)
+    output_name = os.path.splitext(sanitize_filename(video_target.multipart_filename))[0] or "audio"
+    return Response(
+        generate_chunks(output),
+        mimetype='audio/mpeg',
+        headers={'Content-Disposition': f'attachment; filename="{output_name}.mp3"'}
+    )
 
 @app.route('/download/<filename>', methods=['GET'])
 def download_file(filename):
     """Serve the converted files directly"""
+    # Only plain names inside OUTPUT_DIR; '..' would otherwise resolve to SCRATCH_DIR
+    if os.path.basename(filename) != filename or filename in ('.', '..'):
+        return f"File not found: {filename}", 404
     file_path = os.path.join(OUTPUT_DIR, filename)
     
     # Update last accessed time in cache
-    with cache_lock:
-        for file_hash, data in file_cache.items():
-            if os.path.basename(data["output_path"]) == filename:
-                file_cache[file_hash]["last_accessed"] = time.time()
-                break
+    with index_lock:
+        key = filename_to_key.get(filename)
+    if key:
+        touch_cache_entry(key)
     
-    if os.path.exists(file_path):
-        response = send_file(
-            file_path, 
-            as_attachment=True,
-            download_name=filename,
-            mimetype='audio/mpeg'
-        )
-        # Add CORS headers to download response
-        for key, value in CORS_HEADERS.items():
-            response.headers[key] = value
+    # Output names are content hashes, so let the client pick the name it saves under
+    download_name = filename
+    requested_stem = os.path.splitext(sanitize_filename(request.args.get('name', '')))[0]
+    if requested_stem:
+        download_name = requested_stem + os.path.splitext(filename)[1]
+    
+    if os.path.isfile(file_path):
+        mimetype = AUDIO_MIMETYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+        if X_ACCEL_REDIRECT_PREFIX:
+            # nginx streams the file itself, so the worker is released immediately
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX}{filename}"
+            response.headers['Content-Type'] = mimetype
+            response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        else:
+            # gunicorn provides a sendfile(2)-backed wrapper; only fill in one where it's missing
+            request.environ.setdefault('wsgi.file_wrapper', large_buffer_file_wrapper)
+            response = send_file(
+                file_path, 
+                as_attachment=True,
+                download_name=download_name,
+                mimetype=mimetype,
+                conditional=True,  # Answer If-None-Match / Range requests without resending
+                etag=key or True,  # The conversion key is a stable ETag for cached files
+                max_age=CACHE_EXPIRY
+            )
         return response
     else:
         return f"File not found: {filename}", 404
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Keep the JSON error format when Werkzeug rejects a body over MAX_CONTENT_LENGTH"""
+    response = {'success': False, 'error': f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"}
+    return jsonify(response), 413
+
 # Add CORS headers to all responses
 @app.after_request
 def add_cors_headers(response):
-    # Only add headers if they're not already there
-    for key, value in CORS_HEADERS.items():
-        if key not in response.headers:
-            response.headers[key] = value
+    # Every response carries the same fixed CORS values, so overwriting is harmless
+    response.headers.update(CORS_HEADERS)
     return response
 
 @app.route('/files', methods=['GET'])
 def list_files():
     """List all available MP3 files (only shows cached files)"""
-    files = []
-    with cache_lock:
-        for data in file_cache.values():
-            filename = os.path.basename(data["output_path"])
-            if os.path.exists(data["output_path"]):
-                files.append(filename)
+    # The cleanup thread keeps the cache in sync with the disk, so no stat per entry
+    with index_lock:
+        files = list(filename_to_key)
     return jsonify({"files": files})
 
 @app.route('/status', methods=['GET'])
 def status():
     """Provides status information about the service"""
-    with cache_lock:
-        cache_count = len(file_cache)
-        cached_files = [os.path.basename(data["output_path"]) for data in file_cache.values()]
+    with index_lock:
+        cache_count = len(filename_to_key)
     
     return jsonify({
         "status": "running",
@@ -399,6 +1227,31 @@ def status():
         "turnstile_site_key": "0x4AAAAAABHoxdccCZ_9Cezk"  # Add site key for frontend reference
     })
 
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the state of a conversion job queued by /convert"""
+    with jobs_lock:
+        job = dict(jobs[job_id]) if job_id in jobs else None
+    
+    if job is None:
+        response = {'success': False, 'error': "Unknown job"}
+        return jsonify(response), 404
+    
+    response = {'success': job["state"] not in ('failed', 'expired'), 'job_id': job_id, 'state': job["state"]}
+    if job["state"] == 'done':
+        response.update({
+            'filename': job["filename"],
+            'duration': job["duration"],
+            'format': job["format"],
+            'bitrate': job["bitrate"],
+            'cached': False
+        })
+    elif job["state"] == 'failed':
+        response['error'] = job["error"]
+    elif job["state"] == 'expired':
+        response['error'] = "Converted file has expired, please upload the video again"
+    return jsonify(response)
+
 @app.route('/clear-cache', methods=['POST'])
 def clear_cache():
     """Admin endpoint to manually clear the cache"""
@@ -408,12 +1261,15 @@ def clear_cache():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+# Start the cleanup thread when the app is loaded, so it also runs in each gunicorn worker
+start_cleanup_thread()
+logger.info("Started cache cleanup thread")
+logger.info(f"Cache expiry set to {CACHE_EXPIRY} seconds")
+logger.info("Cloudflare Turnstile protection enabled")
+
 if __name__ == '__main__':
-    # Start the cleanup thread when the app starts
-    start_cleanup_thread()
-    logger.info("Started cache cleanup thread")
-    logger.info(f"Cache expiry set to {CACHE_EXPIRY} seconds")
-    logger.info("Cloudflare Turnstile protection enabled")
-    
-    # Run with optimized settings
+    # The Werkzeug dev server is single-process and has no sendfile(2) path; serve with
+    # gunicorn instead so workers scale across cores and downloads use kernel sendfile
+    if os.environ.get('FLASK_ENV') != 'development':
+        raise SystemExit("Run with: gunicorn app:app  (settings are read from gunicorn.conf.py)")
     app.run(host='0.0.0.0', threaded=True)
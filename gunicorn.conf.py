@@ -0,0 +1,21 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app` from this directory
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+
+# The file cache and job table live in process memory, so a job queued by one worker
+# can only be polled on /status/<job_id> through that same worker. Keep a single
+# process by default and scale with threads: FFmpeg does the CPU work in its own
+# processes and hashing/file I/O release the GIL. Raise WEB_CONCURRENCY only behind
+# a load balancer with sticky sessions.
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+# Long uploads and conversions hold a request open for minutes
+timeout = 600
+graceful_timeout = 120
+keepalive = 5
+
+# Worker heartbeat files go to RAM instead of disk
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# app.py creates its scratch directories and starts the cleanup thread at import time
+os.environ.setdefault("SCRATCH_DIR", tempfile.mkdtemp(prefix="koko-tests-"))
+
+import app as koko  # noqa: E402
+
+BOUNDARY = "kokoboundary"
+
+
+def multipart_body(fields, video=None, filename="clip.mp4", close=True):
+    """Build a multipart/form-data body; video=None leaves the file part out"""
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    if video is not None:
+        disposition = f'form-data; name="video"; filename="{filename}"' if filename is not None else 'form-data; name="video"'
+        parts.append(
+            f'--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n'
+            f'Content-Type: video/mp4\r\n\r\n'.encode() + video + b'\r\n'
+        )
+    body = b''.join(parts)
+    if close:
+        body += f'--{BOUNDARY}--\r\n'.encode()
+    return body
+
+
+MULTIPART_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    """The app module with empty caches and scratch directories, and Turnstile always passing"""
+    for directory in (koko.UPLOAD_DIR, koko.OUTPUT_DIR, koko.TEMP_DIR):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+    for shard in koko.file_cache:
+        shard.clear()
+    koko.filename_to_key.clear()
+    koko.jobs.clear()
+    koko.spent_tokens.clear()
+    koko.probe_cache.clear()
+    monkeypatch.setattr(koko, "verify_turnstile_token", lambda token, remote_ip=None: True)
+    return koko
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
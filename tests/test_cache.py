@@ -0,0 +1,56 @@
+import os
+
+
+def cached_output(app_module, file_hash):
+    """Add a converted file to the cache and return its key and path; short hashes are repeated to full length"""
+    key = app_module.conversion_key(file_hash * (64 // len(file_hash)), 'mp3', '192k')
+    path = os.path.join(app_module.OUTPUT_DIR, app_module.output_filename_for(key, 'mp3'))
+    with open(path, 'wb') as f:
+        f.write(b'audio')
+    app_module.add_to_cache(key, path)
+    return key, path
+
+
+def cached_keys(app_module):
+    return {key for shard in app_module.file_cache for key in shard}
+
+
+def test_capacity_is_global_across_shards(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_CACHE_ENTRIES", 3)
+    entries = [cached_output(app_module, prefix) for prefix in ("00", "01", "02", "03")]
+
+    (oldest_key, oldest_path), *kept = entries
+    assert cached_keys(app_module) == {key for key, _ in kept}
+    assert not os.path.exists(oldest_path)
+    assert all(os.path.exists(path) for _, path in kept)
+
+
+def test_crowded_shard_does_not_evict_below_capacity(app_module):
+    # Every hash starts with 00, so all of these land in one shard
+    crowd = app_module.MAX_CACHE_ENTRIES // app_module.CACHE_SHARDS + 2
+    keys = [cached_output(app_module, f"00{n:030x}" * 2)[0] for n in range(crowd)]
+
+    assert cached_keys(app_module) == set(keys)
+
+
+def test_index_matches_cache_after_eviction(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_CACHE_ENTRIES", 2)
+    for prefix in ("10", "20", "30", "40", "20"):
+        cached_output(app_module, prefix)
+
+    assert set(app_module.filename_to_key.values()) == cached_keys(app_module)
+    assert sorted(app_module.filename_to_key) == sorted(os.listdir(app_module.OUTPUT_DIR))
+
+
+def test_evicted_job_is_reported_expired(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_CACHE_ENTRIES", 1)
+    key, path = cached_output(app_module, "aa")
+    app_module.jobs[key] = {"state": 'done', "updated": 0, "upload": "x.upload", "filename": os.path.basename(path),
+                            "duration": 1.0, "format": 'mp3', "bitrate": '192k'}
+
+    cached_output(app_module, "bb")
+    response = client.get(f'/status/{key}')
+
+    assert not os.path.exists(path)
+    assert response.get_json()['state'] == 'expired'
+    assert response.get_json()['success'] is False
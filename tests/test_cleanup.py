@@ -0,0 +1,55 @@
+import os
+import time
+
+
+def scratch_file(directory, name, age):
+    """Create a file whose mtime and atime are age seconds in the past"""
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_sweep_spares_outputs_another_worker_may_still_serve(app_module):
+    # Not in this process's index, but younger than STALE_FILE_TTL
+    recent = scratch_file(app_module.OUTPUT_DIR, "recent.mp3", app_module.CACHE_EXPIRY + 60)
+    stale = scratch_file(app_module.OUTPUT_DIR, "stale.mp3", app_module.STALE_FILE_TTL + 60)
+
+    app_module.cleanup_expired_files()
+
+    assert os.path.exists(recent)
+    assert not os.path.exists(stale)
+
+
+def test_sweep_removes_orphaned_uploads_but_not_queued_ones(app_module):
+    orphan = scratch_file(app_module.UPLOAD_DIR, "orphan.upload", app_module.STALE_FILE_TTL + 60)
+    queued = scratch_file(app_module.UPLOAD_DIR, "queued.upload", app_module.STALE_FILE_TTL + 60)
+    app_module.jobs["key"] = {"state": 'queued', "updated": time.time(), "upload": "queued.upload"}
+
+    app_module.cleanup_expired_files()
+
+    assert not os.path.exists(orphan)
+    assert os.path.exists(queued)
+
+
+def test_cache_hit_refreshes_mtime_for_other_workers(app_module, monkeypatch):
+    key = app_module.conversion_key("ab" * 32, 'mp3', '192k')
+    path = scratch_file(app_module.OUTPUT_DIR, app_module.output_filename_for(key, 'mp3'), app_module.CACHE_EXPIRY + 60)
+    app_module.add_to_cache(key, path)
+    monkeypatch.setattr(app_module, "TOUCH_INTERVAL", 0)
+
+    assert app_module.touch_cache_entry(key) == path
+    assert time.time() - os.path.getmtime(path) < 60
+
+
+def test_sweep_spares_output_adopted_from_disk(app_module):
+    key = app_module.conversion_key("cd" * 32, 'mp3', '192k')
+    path = scratch_file(app_module.OUTPUT_DIR, app_module.output_filename_for(key, 'mp3'), app_module.STALE_FILE_TTL + 60)
+    app_module.add_to_cache(key, path)
+
+    app_module.cleanup_expired_files()
+
+    assert os.path.exists(path)
+    assert app_module.filename_to_key[os.path.basename(path)] == key
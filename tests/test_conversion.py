@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import app as koko
+from conftest import MULTIPART_TYPE, multipart_body
+
+MP3_192K = {"codec_name": "mp3", "sample_rate": "44100", "channels": 2, "bit_rate": "192000"}
+
+
+def test_matching_mp3_is_copied():
+    assert koko.can_stream_copy(MP3_192K, 'mp3', '192k')
+    assert koko.can_stream_copy(MP3_192K, 'mp3', '320k')
+
+
+@pytest.mark.parametrize("overrides, format_type, bitrate", [
+    ({}, 'mp3', '128k'),  # Source is above the requested bitrate
+    ({}, 'wav', '192k'),  # Different output codec
+    ({"codec_name": "aac"}, 'mp3', '192k'),
+    ({"sample_rate": "48000"}, 'mp3', '192k'),
+    ({"channels": 1}, 'mp3', '192k'),
+    ({"bit_rate": None}, 'mp3', '320k'),  # Unknown bitrate
+    ({"bit_rate": "N/A"}, 'mp3', '320k'),
+])
+def test_mismatched_source_is_encoded(overrides, format_type, bitrate):
+    assert not koko.can_stream_copy({**MP3_192K, **overrides}, format_type, bitrate)
+
+
+def test_failed_conversion_leaves_no_output_to_serve(client, app_module, monkeypatch):
+    def partial_ffmpeg(ffmpeg_command, err_file):
+        with open(ffmpeg_command[-1], 'wb') as f:
+            f.write(b'truncated')
+        err_file.write(b'killed')
+        return 1
+
+    monkeypatch.setattr(app_module, "probe_media", lambda video_path, file_hash: {"duration": 1.0, "audio": MP3_192K})
+    monkeypatch.setattr(app_module, "run_ffmpeg", partial_ffmpeg)
+    # Run jobs inline so the failure has happened before the next request
+    monkeypatch.setattr(app_module.conversion_executor, "submit", lambda fn, *args: fn(*args))
+    body = multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes')
+
+    first = client.post('/convert', data=body, content_type=MULTIPART_TYPE)
+    assert app_module.jobs[first.get_json()['job_id']]["state"] == 'failed'
+
+    second = client.post('/convert', data=body, content_type=MULTIPART_TYPE)
+    assert not second.get_json().get('cached')
+    assert os.listdir(app_module.OUTPUT_DIR) == []
@@ -0,0 +1,70 @@
+import io
+import os
+
+from conftest import MULTIPART_TYPE, multipart_body
+
+DIGEST = "ab" * 32
+
+
+def lookup(client, digest=DIGEST, token='t', query='format=mp3&bitrate=192k', **kwargs):
+    headers = {'X-Content-BLAKE3': digest}
+    if token is not None:
+        headers['CF-Turnstile-Response'] = token
+    headers.update(kwargs.pop('headers', {}))
+    return client.post(f'/convert?{query}', headers=headers, **kwargs)
+
+
+def test_cached_digest_is_served_without_upload(client, app_module):
+    key = app_module.conversion_key(DIGEST, 'mp3', '192k')
+    path = os.path.join(app_module.OUTPUT_DIR, app_module.output_filename_for(key, 'mp3'))
+    open(path, 'wb').close()
+    app_module.add_to_cache(key, path)
+
+    response = lookup(client)
+
+    assert response.status_code == 200
+    assert response.get_json() == {'success': True, 'filename': os.path.basename(path), 'cached': True}
+
+
+def test_uncached_digest_without_body_is_not_found(client):
+    response = lookup(client)
+
+    assert response.status_code == 404
+
+
+def test_malformed_digest_is_rejected(client):
+    response = lookup(client, digest="not-a-digest")
+
+    assert response.status_code == 400
+
+
+def test_digest_lookup_requires_turnstile(client, app_module, monkeypatch):
+    assert lookup(client, token=None).status_code == 400
+
+    monkeypatch.setattr(app_module, "verify_turnstile_token", lambda token, remote_ip=None: False)
+    assert lookup(client).status_code == 403
+
+
+def test_chunked_upload_after_miss_is_converted(client, app_module, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app_module.conversion_executor, "submit", lambda *args: submitted.append(args))
+    # The header token was already spent on the lookup, so the form carries none
+    body = multipart_body({}, video=b'video bytes')
+
+    response = lookup(client, input_stream=io.BytesIO(body), content_type=MULTIPART_TYPE,
+                      headers={'Transfer-Encoding': 'chunked'},
+                      environ_overrides={'wsgi.input_terminated': True})
+
+    assert response.status_code == 202
+    assert len(submitted) == 1
+
+
+def test_upload_after_miss_uses_query_string_settings(client, app_module, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app_module.conversion_executor, "submit", lambda *args: submitted.append(args))
+    body = multipart_body({}, video=b'video bytes')
+
+    response = lookup(client, query='format=wav&bitrate=320k', data=body, content_type=MULTIPART_TYPE)
+
+    assert response.status_code == 202
+    assert submitted[0][-2:] == ('wav', '320k')
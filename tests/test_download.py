@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize("filename", ["..", ".", "sub"])
+def test_download_rejects_anything_but_an_output_file(client, app_module, monkeypatch, filename):
+    monkeypatch.setattr(app_module, "X_ACCEL_REDIRECT_PREFIX", "/protected/")
+    os.makedirs(os.path.join(app_module.OUTPUT_DIR, "sub"), exist_ok=True)
+
+    response = client.get(f'/download/{filename}')
+
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_download_serves_output_file(client, app_module):
+    with open(os.path.join(app_module.OUTPUT_DIR, "key.mp3"), 'wb') as f:
+        f.write(b'audio')
+
+    response = client.get('/download/key.mp3')
+
+    assert response.status_code == 200
+    assert response.data == b'audio'
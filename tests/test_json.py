@@ -0,0 +1,28 @@
+import pytest
+
+
+@pytest.fixture
+def provider(app_module):
+    if app_module.orjson is None:
+        pytest.skip("orjson is not installed")
+    return app_module.app.json
+
+
+def test_dumps_maps_stdlib_options(provider):
+    assert provider.dumps({'b': 1, 'a': 2}) == '{"a":2,"b":1}'
+    assert provider.dumps({'b': 1, 'a': 2}, sort_keys=False) == '{"b":1,"a":2}'
+    assert provider.dumps({'a': 1}, indent=4) == '{\n  "a": 1\n}'
+    assert provider.dumps({'a': {1, 2}}, default=sorted) == '{"a":[1,2]}'
+
+
+@pytest.mark.parametrize("args, kwargs, body", [
+    (({'a': 1},), {}, b'{"a":1}\n'),
+    ((1, 2), {}, b'[1,2]\n'),
+    ((), {'a': 1}, b'{"a":1}\n'),
+    ((), {}, b'null\n'),
+])
+def test_response_matches_jsonify(provider, args, kwargs, body):
+    response = provider.response(*args, **kwargs)
+
+    assert response.data == body
+    assert response.mimetype == 'application/json'
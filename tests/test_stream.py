@@ -0,0 +1,120 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import MULTIPART_TYPE, multipart_body
+
+# Stands in for FFmpeg: copies whatever follows -i (stdin or a file) to stdout
+FAKE_FFMPEG = [
+    sys.executable, "-c",
+    "import shutil, sys; src = sys.argv[sys.argv.index('-i') + 1]; "
+    "shutil.copyfileobj(sys.stdin.buffer if src == 'pipe:0' else open(src, 'rb'), sys.stdout.buffer)",
+]
+
+
+def box(box_type, payload=b''):
+    return (8 + len(payload)).to_bytes(4, 'big') + box_type + payload
+
+
+FTYP = box(b'ftyp', b'isom\x00\x00\x02\x00isomiso2mp41')
+FASTSTART_MP4 = FTYP + box(b'moov', b'\x00' * 32) + box(b'mdat', b'\x01' * 64)
+MOOV_AT_END_MP4 = FTYP + box(b'mdat', b'\x01' * 64) + box(b'moov', b'\x00' * 32)
+
+
+@pytest.mark.parametrize("head, expected", [
+    (FASTSTART_MP4, True),
+    (MOOV_AT_END_MP4, False),
+    (b'\x1aE\xdf\xa3' + b'\x00' * 60, True),  # Matroska/WebM
+    (FTYP + box(b'free'), None),
+    (FTYP[:6], None),
+    (FTYP + (1).to_bytes(4, 'big') + b'mdat' + (16).to_bytes(8, 'big'), False),
+], ids=["faststart", "moov-at-end", "webm", "undecided", "short", "64-bit-size"])
+def test_mp4_index_first(app_module, head, expected):
+    assert app_module.mp4_index_first(head) is expected
+
+
+@pytest.fixture
+def spawned(app_module, monkeypatch):
+    """Run the fake FFmpeg and record every process /convert-stream starts"""
+    processes = []
+    real_popen = subprocess.Popen
+
+    def popen(*args, **kwargs):
+        process = real_popen(*args, **kwargs)
+        processes.append(process)
+        return process
+
+    monkeypatch.setattr(app_module, "FFMPEG_BASE_ARGS", FAKE_FFMPEG)
+    monkeypatch.setattr(app_module.subprocess, "Popen", popen)
+    return processes
+
+
+def post_stream(client, **kwargs):
+    return client.post('/convert-stream', content_type=MULTIPART_TYPE,
+                       headers={'CF-Turnstile-Response': 't', 'Transfer-Encoding': 'chunked'},
+                       environ_overrides={'wsgi.input_terminated': True}, **kwargs)
+
+
+@pytest.mark.parametrize("video, piped", [(FASTSTART_MP4, True), (MOOV_AT_END_MP4, False)], ids=["faststart", "moov-at-end"])
+def test_stream_converts_either_box_order(client, app_module, spawned, video, piped):
+    response = post_stream(client, input_stream=io.BytesIO(multipart_body({}, video=video)))
+
+    assert response.status_code == 200
+    assert response.data == video
+    assert len(spawned) == 1
+    assert (spawned[0].args[spawned[0].args.index('-i') + 1] == 'pipe:0') is piped
+    assert os.listdir(app_module.UPLOAD_DIR) == []
+
+
+def slot_is_free(app_module):
+    if not app_module.stream_slots.acquire(blocking=False):
+        return False
+    app_module.stream_slots.release()
+    return True
+
+
+class DisconnectingStream(io.BytesIO):
+    """Request body that drops the connection once the bytes given run out"""
+    def read(self, size=-1):
+        chunk = super().read(size)
+        if not chunk:
+            raise ConnectionResetError("client went away")
+        return chunk
+
+
+@pytest.mark.parametrize("video", [FASTSTART_MP4, MOOV_AT_END_MP4], ids=["faststart", "moov-at-end"])
+def test_stream_disconnect_stops_ffmpeg(client, app_module, spawned, video):
+    body = multipart_body({}, video=video, close=False)
+
+    response = post_stream(client, input_stream=DisconnectingStream(body))
+
+    assert response.status_code >= 400
+    assert all(process.returncode is not None for process in spawned)
+    assert os.listdir(app_module.UPLOAD_DIR) == []
+    assert slot_is_free(app_module)
+
+
+@pytest.mark.parametrize("video", [FASTSTART_MP4, MOOV_AT_END_MP4], ids=["faststart", "moov-at-end"])
+def test_stream_reports_ffmpeg_spawn_failure_as_json(client, app_module, monkeypatch, video):
+    monkeypatch.setattr(app_module, "FFMPEG_BASE_ARGS", ["/nonexistent/ffmpeg"])
+
+    response = post_stream(client, input_stream=io.BytesIO(multipart_body({}, video=video)))
+
+    assert response.status_code == 500
+    assert response.get_json() == {'success': False, 'error': "Could not start FFmpeg"}
+    assert os.listdir(app_module.UPLOAD_DIR) == []
+    assert slot_is_free(app_module)
+
+
+def test_stream_releases_slot_when_scratch_is_full(client, app_module, monkeypatch):
+    def no_space(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(app_module.tempfile, "TemporaryFile", no_space)
+    for _ in range(app_module.MAX_CONVERSION_WORKERS + 1):
+        response = post_stream(client, input_stream=io.BytesIO(multipart_body({}, video=FASTSTART_MP4)))
+        assert response.status_code == 500
+    assert slot_is_free(app_module)
@@ -0,0 +1,98 @@
+import io
+import os
+
+from conftest import MULTIPART_TYPE, multipart_body
+
+
+def upload_files(app_module):
+    return os.listdir(app_module.UPLOAD_DIR)
+
+
+def post_body(client, body, **kwargs):
+    return client.post('/convert', data=body, content_type=MULTIPART_TYPE, **kwargs)
+
+
+def test_queued_upload_is_kept_for_the_job(client, app_module, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app_module.conversion_executor, "submit", lambda *args: submitted.append(args))
+
+    response = post_body(client, multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes'))
+
+    assert response.status_code == 202
+    assert len(submitted) == 1
+    video_path = submitted[0][3]
+    assert os.path.exists(video_path)
+    with open(video_path, 'rb') as f:
+        assert f.read() == b'video bytes'
+
+
+def test_video_part_without_filename_is_removed(client, app_module):
+    body = multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes', filename=None)
+
+    response = post_body(client, body)
+
+    assert response.status_code == 400
+    assert upload_files(app_module) == []
+
+
+def test_truncated_body_is_rejected_and_removed(client, app_module, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app_module.conversion_executor, "submit", lambda *args: submitted.append(args))
+    body = multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes', close=False)
+    body = body[:-len(b'\r\n')]  # Cut off before the next boundary ever arrives
+
+    response = post_body(client, body)
+
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Incomplete upload"
+    assert submitted == []
+    assert upload_files(app_module) == []
+
+
+def test_failed_turnstile_removes_upload(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "verify_turnstile_token", lambda token, remote_ip=None: False)
+
+    response = post_body(client, multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes'))
+
+    assert response.status_code == 403
+    assert upload_files(app_module) == []
+
+
+def test_oversized_chunked_upload_is_removed(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_FILE_SIZE", 64)
+    body = multipart_body({'cf-turnstile-response': 't'}, video=b'x' * 1024)
+
+    # No Content-Length, so the limit is only enforced while reading
+    response = client.post('/convert', input_stream=io.BytesIO(body), content_type=MULTIPART_TYPE,
+                           headers={'Transfer-Encoding': 'chunked'},
+                           environ_overrides={'wsgi.input_terminated': True})
+
+    assert response.status_code == 413
+    assert upload_files(app_module) == []
+
+
+class DisconnectingStream(io.BytesIO):
+    """Request body that drops the connection once the bytes given run out"""
+    def read(self, size=-1):
+        chunk = super().read(size)
+        if not chunk:
+            raise ConnectionResetError("client went away")
+        return chunk
+
+
+def test_client_disconnect_removes_upload(client, app_module):
+    body = multipart_body({'cf-turnstile-response': 't'}, video=b'video bytes', close=False)
+
+    response = client.post('/convert', input_stream=DisconnectingStream(body), content_type=MULTIPART_TYPE,
+                           headers={'Transfer-Encoding': 'chunked'},
+                           environ_overrides={'wsgi.input_terminated': True})
+
+    assert response.status_code >= 400
+    assert upload_files(app_module) == []
+
+
+def test_sanitize_filename_does_not_grow_the_table(app_module):
+    size = len(app_module._FILENAME_TABLE)
+
+    assert app_module.sanitize_filename("../clip ç日本 1.mp4") == "clip__1.mp4"
+    assert len(app_module._FILENAME_TABLE) == size